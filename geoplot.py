@@ -5,8 +5,11 @@ geoplot.py
 This visualization renders a 3-D plot of the data given the state
 trajectory of a simulation, and the path of the property to render.
 
-It generates an HTML file that contains code to render the plot
-using Cesium Ion, and the GeoJSON file of data provided to the plot.
+It generates an HTML file (`<name>.html`) that contains code to render
+the plot using Cesium Ion, and a newline-delimited GeoJSON file
+(`<name>.geojsonl`) of the data provided to the plot, with one feature
+per line. `<name>` is the simulation name in the config's
+`simulation_metadata`.
 
 An example of its usage is as follows:
 
@@ -22,6 +25,11 @@ engine = GeoPlot(config, {
   step_time: 3600,
   coordinates = "agents/consumers/coordinates",
   feature = "agents/consumers/money_spent",
+  visualization_type = "color",
+  # optional: serialize the agents in this many worker processes; the
+  # calling script must then guard its entry point with
+  # `if __name__ == "__main__":`
+  workers = 4,
 })
 
 # visualize in the runner-loop
@@ -33,10 +41,19 @@ for i in range(0, num_episodes):
 
 import re
 import json
+import shutil
 
 import pandas as pd
 import numpy as np
 
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from string import Template
 from agent_torch.core.helpers import get_by_path
 
@@ -64,6 +81,8 @@ geoplot_template = """
 	</head>
 	<body>
 		<div id="cesiumContainer"></div>
+		<script id="geoData" type="application/geo+json-seq">
+$data</script>
 		<script>
 			Cesium.Ion.defaultAccessToken = '$accessToken'
 			const viewer = new Cesium.Viewer('cesiumContainer')
@@ -77,75 +96,74 @@ geoplot_template = """
 				return result
 			}
 
-			function getColor(value, min, max) {
-				const factor = (value - min) / (max - min)
-				return interpolateColor(Cesium.Color.BLUE, Cesium.Color.RED, factor)
-			}
-
-			function getPixelSize(value, min, max) {
-				const factor = (value - min) / (max - min)
-				return 100 * (1 + factor)
+			// each feature carries its value quantized into one of 256 bins,
+			// so colors and sizes are looked up instead of computed per sample
+			const colors = Array.from({ length: 256 }, (_, bin) =>
+				interpolateColor(Cesium.Color.BLUE, Cesium.Color.RED, bin / 255)
+			)
+			const pixelSizes = Array.from({ length: 256 }, (_, bin) => 100 * (1 + bin / 255))
+
+			function createEntity(id, startTime, stopTime) {
+				return new Cesium.Entity({
+					id: id,
+					availability: new Cesium.TimeIntervalCollection([
+						new Cesium.TimeInterval({ start: startTime, stop: stopTime }),
+					]),
+					position: new Cesium.SampledPositionProperty(),
+					point: {
+						pixelSize: '$visualType' == 'size' ? new Cesium.SampledProperty(Number) : 10,
+						color: new Cesium.SampledProperty(Cesium.Color),
+					},
+					properties: {
+						value: new Cesium.SampledProperty(Number),
+					},
+				})
 			}
 
-			function processTimeSeriesData(geoJsonData) {
-				const timeSeriesMap = new Map()
-				let minValue = Infinity
-				let maxValue = -Infinity
+			function addFeature(dataSource, feature, startTime, stopTime) {
+				const { id, time, value, bin } = feature.properties
+				const coordinates = feature.geometry.coordinates
 
-				geoJsonData.features.forEach((feature) => {
-					const id = feature.properties.id
-					const time = Cesium.JulianDate.fromIso8601(feature.properties.time)
-					const value = feature.properties.value
-					const coordinates = feature.geometry.coordinates
+				let entity = dataSource.entities.getById(id)
+				if (!entity) {
+					entity = dataSource.entities.add(createEntity(id, startTime, stopTime))
+				}
 
-					if (!timeSeriesMap.has(id)) {
-						timeSeriesMap.set(id, [])
-					}
-					timeSeriesMap.get(id).push({ time, value, coordinates })
-					minValue = Math.min(minValue, value)
-					maxValue = Math.max(maxValue, value)
-				})
+				const julianTime = Cesium.JulianDate.fromIso8601(time)
+				const position = Cesium.Cartesian3.fromDegrees(coordinates[0], coordinates[1])
+				entity.position.addSample(julianTime, position)
+				entity.properties.value.addSample(julianTime, value)
+				entity.point.color.addSample(julianTime, colors[bin])
 
-				return { timeSeriesMap, minValue, maxValue }
+				if ('$visualType' == 'size') {
+					entity.point.pixelSize.addSample(julianTime, pixelSizes[bin])
+				}
 			}
 
-			function createTimeSeriesEntities(timeSeriesData, startTime, stopTime) {
-				const dataSource = new Cesium.CustomDataSource('AgentTorch Simulation')
-
-				for (const [id, timeSeries] of timeSeriesData.timeSeriesMap) {
-					const entity = new Cesium.Entity({
-						id: id,
-						availability: new Cesium.TimeIntervalCollection([
-							new Cesium.TimeInterval({ start: startTime, stop: stopTime }),
-						]),
-						position: new Cesium.SampledPositionProperty(),
-						point: {
-							pixelSize: '$visualType' == 'size' ? new Cesium.SampledProperty(Number) : 10,
-							color: new Cesium.SampledProperty(Cesium.Color),
-						},
-						properties: {
-							value: new Cesium.SampledProperty(Number),
-						},
-					})
-
-					timeSeries.forEach(({ time, value, coordinates }) => {
-						const position = Cesium.Cartesian3.fromDegrees(coordinates[0], coordinates[1])
-						entity.position.addSample(time, position)
-						entity.properties.value.addSample(time, value)
-						entity.point.color.addSample(time, getColor(value, timeSeriesData.minValue, timeSeriesData.maxValue))
-
-						if ('$visualType' == 'size') {
-							entity.point.pixelSize.addSample(time, getPixelSize(value, timeSeriesData.minValue, timeSeriesData.maxValue))
-						}
-					})
-
-					dataSource.entities.add(entity)
+			// the data holds one feature per line; parse it a batch of lines at
+			// a time, so agents are drawn while the rest are still loading
+			function loadFeatures(dataSource, text, startTime, stopTime, offset = 0) {
+				dataSource.entities.suspendEvents()
+				for (let count = 0; count < 10000 && offset < text.length; count++) {
+					let end = text.indexOf('\\n', offset)
+					if (end == -1) {
+						end = text.length
+					}
+					const line = text.slice(offset, end).trim()
+					if (line) {
+						addFeature(dataSource, JSON.parse(line), startTime, stopTime)
+					}
+					offset = end + 1
 				}
+				dataSource.entities.resumeEvents()
 
-				return dataSource
+				if (offset < text.length) {
+					setTimeout(() => loadFeatures(dataSource, text, startTime, stopTime, offset))
+				} else {
+					viewer.zoomTo(dataSource)
+				}
 			}
 
-			const geoJsons = $data
 			const start = Cesium.JulianDate.fromIso8601('$startTime')
 			const stop = Cesium.JulianDate.fromIso8601('$stopTime')
 
@@ -157,20 +175,121 @@ geoplot_template = """
 
 			viewer.timeline.zoomTo(start, stop)
 
-			for (const geoJsonData of geoJsons) {
-				const timeSeriesData = processTimeSeriesData(geoJsonData)
-				const dataSource = createTimeSeriesEntities(timeSeriesData, start, stop)
-				viewer.dataSources.add(dataSource)
-				viewer.zoomTo(dataSource)
-			}
+			const dataSource = new Cesium.CustomDataSource('AgentTorch Simulation')
+			viewer.dataSources.add(dataSource)
+			loadFeatures(dataSource, document.getElementById('geoData').textContent, start, stop)
 		</script>
 	</body>
 </html>
 """
 
+# the page is written in two parts, with the data streamed in between
+geoplot_template_head, geoplot_template_tail = geoplot_template.split("$data", 1)
+
 def read_var(state, var):
     return get_by_path(state, re.split("/", var))
 
+def read_final_values(episodes, var):
+    """
+    Reads `var` from the final state of each episode into one array, with
+    a row per episode and a column per agent.
+    """
+    return np.stack(
+        [np.asarray(read_var(episode[-1], var)).ravel() for episode in episodes]
+    )
+
+def dumps(obj):
+    """
+    Serializes `obj` to compact JSON bytes, using orjson when it is
+    installed and the standard library otherwise. Floats in `obj` must be
+    finite, see `to_json_list`.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(
+        obj, ensure_ascii=False, separators=(",", ":"), allow_nan=False
+    ).encode("utf-8")
+
+def to_json_list(column):
+    """
+    Converts a NumPy column to a list, replacing values that are not
+    finite with None, so that every serializer writes them as null.
+    """
+    if column.dtype.kind != "f":
+        return column.tolist()
+    return np.where(np.isfinite(column), column, None).tolist()
+
+def quantize(values, num_bins=256):
+    """
+    Maps `values` linearly onto the integers [0, num_bins), with the
+    smallest value in bin 0 and the largest in the last bin. Values that
+    are not finite are put in bin 0.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    finite = np.isfinite(values)
+    if not finite.any():
+        return np.zeros(values.shape, dtype=np.uint8)
+    low, high = values[finite].min(), values[finite].max()
+    if high == low:
+        return np.zeros(values.shape, dtype=np.uint8)
+    bins = np.rint((values - low) / (high - low) * (num_bins - 1))
+    return np.where(finite, bins, 0).astype(np.uint8)
+
+def dump_features(coords, values, bins, times, first_id=0):
+    """
+    Serializes the features of each agent as newline-delimited JSON,
+    yielding the bytes of each agent in turn. Agents are numbered from
+    `first_id`, in the `id` property of their features.
+    """
+    lons, lats = to_json_list(coords[:, 1]), to_json_list(coords[:, 0])
+    for i, (lon, lat) in enumerate(zip(lons, lats)):
+        # an agent does not move, so all its features share one geometry
+        geometry = {"type": "Point", "coordinates": [lon, lat]}
+        yield b"".join(
+            dumps(
+                {
+                    "type": "Feature",
+                    "geometry": geometry,
+                    "properties": {
+                        "id": first_id + i,
+                        "value": value,
+                        "bin": bin,
+                        "time": time,
+                    },
+                }
+            )
+            + b"\n"
+            for time, value, bin in zip(
+                times, to_json_list(values[:, i]), bins[:, i].tolist()
+            )
+        )
+
+def dump_features_chunk(args):
+    """
+    Serializes a chunk of agents in a worker process.
+    """
+    return list(dump_features(*args))
+
+def write_geojson(f, coords, values, bins, times, workers=1):
+    """
+    Writes the features of every agent to the binary file `f`, one per
+    line. With more than one worker, the agents are split into chunks
+    that are serialized in separate processes.
+    """
+    if workers > 1:
+        bounds = np.linspace(0, len(coords), 4 * workers + 1).astype(int)
+        chunks = [
+            (coords[a:b], values[:, a:b], bins[:, a:b], times, a.item())
+            for a, b in zip(bounds[:-1], bounds[1:])
+            if b > a
+        ]
+        with ProcessPoolExecutor(workers) as executor:
+            f.writelines(
+                chain.from_iterable(executor.map(dump_features_chunk, chunks))
+            )
+    else:
+        f.writelines(dump_features(coords, values, bins, times))
+
 class GeoPlot:
     def __init__(self, config, options):
         self.config = config
@@ -187,60 +306,62 @@ class GeoPlot:
             options["feature"],
             options["visualization_type"],
         )
+        self.workers = options.get("workers", 1)
+
+        # fill in the placeholders known up front; `$` is escaped so that
+        # the times can still be substituted into the result in `render`
+        static = {
+            "accessToken": self.cesium_token.replace("$", "$$"),
+            "visualType": self.visualization_type.replace("$", "$$"),
+        }
+        self.template_head, self.template_tail = (
+            Template(Template(part).safe_substitute(static))
+            for part in (geoplot_template_head, geoplot_template_tail)
+        )
 
     def render(self, state_trajectory):
-        coords, values = [], []
+        # the last entry of the trajectory is the episode still in progress
+        if len(state_trajectory) < 2:
+            raise ValueError(
+                "state_trajectory must contain at least one completed episode"
+            )
+
         name = self.config["simulation_metadata"]["name"]
-        geodata_path, geoplot_path = f"{name}.geojson", f"{name}.html"
+        geodata_path, geoplot_path = f"{name}.geojsonl", f"{name}.html"
 
-        for i in range(0, len(state_trajectory) - 1):
-            final_state = state_trajectory[i][-1]
-            coords = np.array(read_var(final_state, self.entity_position)).tolist()
-            values.append(
-                np.array(read_var(final_state, self.entity_property)).flatten().tolist()
-            )
+        # agents are plotted at their positions in the last episode
+        final_state = state_trajectory[-2][-1]
+        coords = np.ascontiguousarray(
+            read_var(final_state, self.entity_position), dtype=np.float64
+        )
 
-        start_time = pd.Timestamp.utcnow()
-        timestamps = [
-            start_time + pd.Timedelta(seconds=i * self.step_time)
-            for i in range(
-                self.config["simulation_metadata"]["num_episodes"]
-                * self.config["simulation_metadata"]["num_steps_per_episode"]
-            )
-        ]
+        values = read_final_values(state_trajectory[:-1], self.entity_property)
 
-        geojsons = []
-        for i, coord in enumerate(coords):
-            features = []
-            for time, value_list in zip(timestamps, values):
-                features.append(
-                    {
-                        "type": "Feature",
-                        "geometry": {
-                            "type": "Point",
-                            "coordinates": [coord[1], coord[0]],
-                        },
-                        "properties": {
-                            "value": value_list[i],
-                            "time": time.isoformat(),
-                        },
-                    }
-                )
-            geojsons.append({"type": "FeatureCollection", "features": features})
-
-        with open(geodata_path, "w", encoding="utf-8") as f:
-            json.dump(geojsons, f, ensure_ascii=False, indent=2)
-
-        tmpl = Template(geoplot_template)
-        with open(geoplot_path, "w", encoding="utf-8") as f:
-            f.write(
-                tmpl.substitute(
-                    {
-                        "accessToken": self.cesium_token,
-                        "startTime": timestamps[0].isoformat(),
-                        "stopTime": timestamps[-1].isoformat(),
-                        "data": json.dumps(geojsons),
-                        "visualType": self.visualization_type,
-                    }
-                )
+        timestamps = pd.date_range(
+            start=pd.Timestamp.now("UTC"),
+            periods=self.config["simulation_metadata"]["num_episodes"]
+            * self.config["simulation_metadata"]["num_steps_per_episode"],
+            freq=pd.Timedelta(seconds=self.step_time),
+        )
+        # format every timestamp once, rather than once per agent
+        iso_times = timestamps.strftime("%Y-%m-%dT%H:%M:%S.%fZ").tolist()
+
+        with open(geodata_path, "wb") as f:
+            write_geojson(
+                f,
+                coords,
+                values,
+                quantize(values),
+                iso_times,
+                self.workers,
             )
+
+        times = {"startTime": iso_times[0], "stopTime": iso_times[-1]}
+        head = self.template_head.substitute(times)
+        tail = self.template_tail.substitute(times)
+        with open(geoplot_path, "wb") as f:
+            f.write(head.encode("utf-8"))
+            # embed the data by copying the file, instead of serializing again
+            with open(geodata_path, "rb") as data:
+                shutil.copyfileobj(data, f)
+            f.write(tail.encode("utf-8"))